@@ -1,16 +1,39 @@
 from dotenv import load_dotenv
 import streamlit as st
 import os
-import mysql.connector
 import pandas as pd
+import altair as alt
 import google.generativeai as genai
-import sqlite3
-import psycopg2
 from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
+from sqlalchemy.exc import ResourceClosedError
 import traceback
+import re
+import sqlparse
+from ratelimit import limits, sleep_and_retry
+
+try:
+    import sqlglot
+    from sqlglot import exp
+except ImportError:
+    sqlglot = None
 
 # Configuration
 load_dotenv()
+QUERY_CHUNK_SIZE = 10_000
+MAX_RESULT_ROWS = 1000
+GEMINI_CALLS_PER_MINUTE = 50
+SQLGLOT_DIALECTS = {"postgresql": "postgres"}
+_SELECT_RE = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+_LIMIT_RE = re.compile(r"\b(?:limit\s+(?:\d+\s*,\s*)?|fetch\s+(?:first|next)\s+)(\d+)", re.IGNORECASE)
+_TRAILING_SEMICOLON_RE = re.compile(r";?\s*\Z")
+# Known SQL info strings are stripped even on a one-line fence (```sql SELECT 1```); any other
+# info string only counts when it ends its line, so ```SELECT 1``` keeps its first keyword
+_FENCE_RE = re.compile(
+    r"\A\s*```(?:(?i:sql|mysql|postgres(?:ql)?|sqlite)\b|[\w+-]+(?=[ \t]*\r?\n))?\s*|\s*```\s*\Z",
+    re.DOTALL
+)
+SQL_DEBUG = os.getenv("SQL_DEBUG", "").lower() in ("1", "true")
 try:
     api_key = os.getenv("GOOGLE_API_KEY")
     if not api_key:
@@ -21,99 +44,120 @@ except Exception as e:
     st.error(f"❌ Error loading configuration: {str(e)}")
     st.stop()
 
+# Prompt
+PROMPT = """You are a healthcare SQL expert. Database schema:
+PATIENTS (patient_id, first_name, last_name, dob, gender, phone, insurance_id)
+DOCTORS (doctor_id, first_name, last_name, specialization, department_id, license_number, phone)
+DEPARTMENTS (department_id, name, head_doctor_id)
+APPOINTMENTS (appointment_id, patient_id, doctor_id, appointment_date, status)
+MEDICAL_RECORDS (record_id, patient_id, doctor_id, diagnosis, prescription, record_date)
+LAB_RESULTS (lab_id, patient_id, test_name, test_date, result_value, reference_range)
+
+Rules:
+1. Use explicit JOIN syntax
+2. Format dates using DATE_FORMAT()
+3. Always qualify column names with table aliases
+4. Include relevant WHERE clauses
+5. Handle NULL values appropriately"""
+
 # Test Database Connection
 def test_db_connection(db_type, host, user, password, database, port=None):
+    # Drivers are imported only for the selected database type to keep startup light
     try:
         if db_type == "MySQL":
-            conn = mysql.connector.connect(
-                host=host,
-                user=user,
-                password=password,
-                database=database,
-                port=port or 3306
-            )
-            conn.close()
-            return True, "✅ Successfully connected to MySQL database"
+            import mysql.connector
+            try:
+                conn = mysql.connector.connect(
+                    host=host,
+                    user=user,
+                    password=password,
+                    database=database,
+                    port=port or 3306
+                )
+                conn.close()
+                return True, "✅ Successfully connected to MySQL database"
+            except mysql.connector.Error as err:
+                if err.errno == mysql.connector.errorcode.ER_ACCESS_DENIED_ERROR:
+                    return False, "❌ Access denied. Please check your username and password"
+                elif err.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
+                    return False, f"❌ Database '{database}' does not exist"
+                else:
+                    return False, f"❌ MySQL Error: {str(err)}"
         elif db_type == "PostgreSQL":
-            conn = psycopg2.connect(
-                host=host,
-                user=user,
-                password=password,
-                database=database,
-                port=port or 5432
-            )
-            conn.close()
-            return True, "✅ Successfully connected to PostgreSQL database"
+            import psycopg2
+            try:
+                conn = psycopg2.connect(
+                    host=host,
+                    user=user,
+                    password=password,
+                    database=database,
+                    port=port or 5432
+                )
+                conn.close()
+                return True, "✅ Successfully connected to PostgreSQL database"
+            except psycopg2.Error as err:
+                return False, f"❌ PostgreSQL Error: {str(err)}"
         elif db_type == "SQLite":
+            import sqlite3
             if not os.path.exists(database):
                 return False, "❌ SQLite database file not found"
-            conn = sqlite3.connect(database)
-            conn.close()
-            return True, "✅ Successfully connected to SQLite database"
+            try:
+                conn = sqlite3.connect(database)
+                conn.close()
+                return True, "✅ Successfully connected to SQLite database"
+            except sqlite3.Error as err:
+                return False, f"❌ SQLite Error: {str(err)}"
         else:
             return False, f"❌ Unsupported database type: {db_type}"
-    except mysql.connector.Error as err:
-        if err.errno == mysql.connector.errorcode.ER_ACCESS_DENIED_ERROR:
-            return False, "❌ Access denied. Please check your username and password"
-        elif err.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
-            return False, f"❌ Database '{database}' does not exist"
-        else:
-            return False, f"❌ MySQL Error: {str(err)}"
-    except psycopg2.Error as err:
-        return False, f"❌ PostgreSQL Error: {str(err)}"
-    except sqlite3.Error as err:
-        return False, f"❌ SQLite Error: {str(err)}"
     except Exception as err:
         return False, f"❌ Unexpected error: {str(err)}"
 
-# Database Connection
-def get_db_connection(db_type, host, user, password, database, port=None):
-    try:
-        if db_type == "MySQL":
-            return mysql.connector.connect(
-                host=host,
-                user=user,
-                password=password,
-                database=database,
-                port=port or 3306
-            )
-        elif db_type == "PostgreSQL":
-            return psycopg2.connect(
-                host=host,
-                user=user,
-                password=password,
-                database=database,
-                port=port or 5432
-            )
-        elif db_type == "SQLite":
-            if not os.path.exists(database):
-                raise FileNotFoundError(f"SQLite database file not found: {database}")
-            return sqlite3.connect(database)
-        else:
-            raise ValueError(f"Unsupported database type: {db_type}")
-    except mysql.connector.Error as err:
-        if err.errno == mysql.connector.errorcode.ER_ACCESS_DENIED_ERROR:
-            st.error("❌ Database access denied. Please check your username and password.")
-        elif err.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
-            st.error(f"❌ Database '{database}' does not exist.")
-        else:
-            st.error(f"❌ MySQL Error: {str(err)}")
-        st.stop()
-    except psycopg2.Error as err:
-        st.error(f"❌ PostgreSQL Error: {str(err)}")
-        st.stop()
-    except sqlite3.Error as err:
-        st.error(f"❌ SQLite Error: {str(err)}")
-        st.stop()
-    except Exception as err:
-        st.error(f"❌ Unexpected error during database connection: {str(err)}")
-        st.stop()
+# Database URL
+def make_db_url(db_config):
+    db_type = db_config["type"]
+    if db_type == "MySQL":
+        return URL.create("mysql+mysqlconnector", username=db_config["user"], password=db_config["password"],
+                          host=db_config["host"], port=db_config["port"] or 3306, database=db_config["database"])
+    elif db_type == "PostgreSQL":
+        return URL.create("postgresql+psycopg2", username=db_config["user"], password=db_config["password"],
+                          host=db_config["host"], port=db_config["port"] or 5432, database=db_config["database"])
+    elif db_type == "SQLite":
+        if not os.path.exists(db_config["path"]):
+            raise FileNotFoundError(f"SQLite database file not found: {db_config['path']}")
+        return URL.create("sqlite", database=db_config["path"])
+    else:
+        raise ValueError(f"Unsupported database type: {db_type}")
+
+# Database Engine
+@st.cache_resource(show_spinner=False)
+def get_db_engine(db_config):
+    # Built once per connection settings; Streamlit keys the cache on a hash of the config.
+    # No TTL: an evicted engine would stay alive in sessions while a second pool was built.
+    # Connections go back to the pool on exit and are pinged before reuse.
+    return create_engine(make_db_url(db_config), pool_size=5, max_overflow=10, pool_pre_ping=True)
+
+# AI Model
+@st.cache_resource(show_spinner=False)
+def get_gemini_model():
+    return genai.GenerativeModel('gemini-1.5-flash-latest')
+
+# AI Rate Limiting
+@sleep_and_retry
+@limits(calls=GEMINI_CALLS_PER_MINUTE, period=60)
+def call_gemini(model, contents):
+    # Process-wide, so every Streamlit session shares the budget and waits instead of hitting 429s
+    return model.generate_content(contents)
 
 # AI Response Generation
-def get_gemini_response(question, prompt):
+def get_gemini_response(question, prompt_text):
+    # Collapse whitespace so trivially different submissions share a cache entry
+    return generate_sql_from_question(" ".join(question.split()), prompt_text)
+
+@st.cache_data(ttl=600, show_spinner=False)
+def generate_sql_from_question(question, prompt_text):
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        response = model.generate_content([prompt[0], question])
+        model = get_gemini_model()
+        response = call_gemini(model, [prompt_text, question])
         if not response.text:
             raise ValueError("Empty response from AI model")
         return response.text
@@ -122,37 +166,132 @@ def get_gemini_response(question, prompt):
         st.error("Please check if your Google API key is valid and has sufficient quota.")
         st.stop()
 
+# Row Limit
+def apply_row_limit(sql_query, dialect):
+    # Fetch one row past the cap so the UI can tell when results were truncated
+    row_limit = MAX_RESULT_ROWS + 1
+    if sqlglot is not None:
+        try:
+            expression = sqlglot.parse_one(sql_query, read=dialect)
+        except sqlglot.errors.SqlglotError:
+            return sql_query
+        if isinstance(expression, exp.Query):
+            limit = expression.args.get("limit")
+            if limit is None:
+                return expression.limit(row_limit).sql(dialect=dialect)
+            # Lower an explicit LIMIT/FETCH above the cap too, so the transfer stays bounded
+            count = limit.expression if isinstance(limit, exp.Limit) else limit.args.get("count")
+            if isinstance(count, exp.Literal) and count.is_int and int(count.this) > row_limit:
+                return expression.limit(row_limit).sql(dialect=dialect)
+        return sql_query
+    if _SELECT_RE.match(sql_query):
+        limits = list(_LIMIT_RE.finditer(sql_query))
+        if not limits:
+            return _TRAILING_SEMICOLON_RE.sub(f" LIMIT {row_limit}", sql_query, count=1)
+        last_limit = limits[-1]
+        if int(last_limit.group(1)) > row_limit:
+            return sql_query[:last_limit.start(1)] + str(row_limit) + sql_query[last_limit.end(1):]
+    return sql_query
+
+# Streaming Check
+def is_streamable_query(statement):
+    # Server-side cursors run the statement as DECLARE ... CURSOR FOR, which PostgreSQL only
+    # accepts for plain queries: not DML, SELECT ... INTO or data-modifying CTEs
+    parsed = sqlparse.parse(statement)[0]
+    if parsed.get_type() != "SELECT":
+        return False
+    return not any(token.is_keyword and token.normalized in ("INTO", "INSERT", "UPDATE", "DELETE", "MERGE")
+                   for token in parsed.flatten())
+
+# Query Preparation
+def prepare_sql_statements(sql_query, dialect_name):
+    sql_query = _FENCE_RE.sub("", sql_query).strip()
+    if SQL_DEBUG:
+        # Catch fences the regex missed before they reach the database as a syntax error
+        assert "```" not in sql_query, f"Unstripped code fence in generated SQL: {sql_query!r}"
+    # Comments are dropped so a trailing "; -- note" can't hide the final query from the row limit
+    statements = [sqlparse.format(statement, strip_comments=True).strip()
+                  for statement in sqlparse.split(sql_query)]
+    statements = [statement for statement in statements if statement]
+    if not statements:
+        return [], []
+    # Only the last statement's rows are shown, so earlier read-only queries would be fetched
+    # in full and thrown away; skip them and keep statements with side effects
+    *leading_statements, final_statement = statements
+    skipped_statements = [statement for statement in leading_statements if is_streamable_query(statement)]
+    statements = [statement for statement in leading_statements if not is_streamable_query(statement)]
+    statements.append(apply_row_limit(final_statement, SQLGLOT_DIALECTS.get(dialect_name, dialect_name)))
+    return statements, skipped_statements
+
 # Query Execution
-def execute_sql_query(sql_query, db_type, host, user, password, database, port=None):
-    sql_query = sql_query.strip().strip("```sql").strip("```")
+def execute_sql_query(statements, engine):
+    if not statements:
+        return None
+    *leading_statements, final_statement = statements
     
     try:
-        conn = get_db_connection(db_type, host, user, password, database, port)
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute(sql_query)
-        except Exception as e:
-            st.error(f"❌ SQL Query Error: {str(e)}")
-            st.error("Please check your SQL query syntax and table structure.")
-            return None, None
-        
-        if cursor.description:
-            columns = [col[0] for col in cursor.description]
-            rows = cursor.fetchall()
-            return columns, rows
-        return None, None
+        with engine.connect() as conn:
+            # no_parameters keeps the DBAPI from treating "%" in LIKE patterns as placeholders
+            conn = conn.execution_options(no_parameters=True)
+            try:
+                if leading_statements:
+                    if engine.dialect.name == "postgresql":
+                        # psycopg2 sends a multi-statement string in a single round trip
+                        conn.exec_driver_sql("\n".join(leading_statements))
+                    else:
+                        for statement in leading_statements:
+                            conn.exec_driver_sql(statement)
+                
+                if not is_streamable_query(final_statement):
+                    # DML, SELECT ... INTO, data-modifying CTEs and utility statements
+                    # (SHOW, EXPLAIN, ...) run on a plain cursor
+                    result = conn.exec_driver_sql(final_statement)
+                    df = None
+                    if result.returns_rows:
+                        df = pd.DataFrame(result.fetchall(), columns=list(result.keys())).convert_dtypes(
+                            dtype_backend="pyarrow")
+                else:
+                    # yield_per streams through a server-side cursor where the driver supports one
+                    # (single statement only) and fetches from the DBAPI cursor in fixed-size
+                    # batches rather than SQLAlchemy's default row buffer growing from one row
+                    conn = conn.execution_options(yield_per=QUERY_CHUNK_SIZE)
+                    # Arrow-backed columns hand straight to st.dataframe without a numpy round trip
+                    chunks = pd.read_sql_query(final_statement, conn, chunksize=QUERY_CHUNK_SIZE,
+                                               dtype_backend="pyarrow")
+                    df = pd.concat(chunks, ignore_index=True)
+                
+                # The script is one transaction: commit once every statement has succeeded;
+                # on any error the connection closes without committing and it all rolls back
+                conn.commit()
+                return df
+            except ResourceClosedError:
+                # A streamed query that still produced no result set
+                conn.commit()
+                return None
+            except Exception as e:
+                st.error(f"❌ SQL Query Error: {str(e)}")
+                st.error("Please check your SQL query syntax and table structure.")
+                return None
         
     except Exception as err:
         st.error(f"❌ Database Error: {str(err)}")
-        return None, None
-    finally:
-        try:
-            if hasattr(conn, 'close'):
-                cursor.close()
-                conn.close()
-        except Exception as e:
-            st.warning(f"⚠️ Warning: Error while closing database connection: {str(e)}")
+        return None
+
+# Visualization
+@st.cache_data(show_spinner=False, hash_funcs={pd.ArrowDtype: str})
+def get_numeric_columns(dtypes):
+    # Positions rather than names: JOINs like "SELECT p.patient_id, a.patient_id" repeat column names
+    return [position for position, dtype in enumerate(dtypes)
+            if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)]
+
+def build_line_chart(df, position):
+    # Plot against a positional row axis; column names are passed as fields, not shorthand
+    values = df.iloc[:, position].astype("float64").to_numpy()
+    chart_df = pd.DataFrame({"row": range(len(df)), "value": values})
+    return alt.Chart(chart_df).mark_line().encode(
+        x=alt.X("row", type="quantitative", title="Row"),
+        y=alt.Y("value", type="quantitative", title=str(df.columns[position]))
+    )
 
 # --- Streamlit UI ---
 def main():
@@ -164,6 +303,10 @@ def main():
         st.session_state.db_connected = False
     if 'db_config' not in st.session_state:
         st.session_state.db_config = {}
+    if 'db_engine' not in st.session_state:
+        st.session_state.db_engine = None
+    if 'query_result' not in st.session_state:
+        st.session_state.query_result = None
     
     # Database Connection Settings
     with st.sidebar:
@@ -176,20 +319,25 @@ def main():
                 index=0
             )
             
-            if db_type != "SQLite":
-                db_host = st.text_input("Host *", value="localhost")
-                db_user = st.text_input("Username *", value="root")
-                db_password = st.text_input("Password *", type="password")
-                db_port = st.number_input("Port *", min_value=1, max_value=65535, 
-                                        value=3306 if db_type == "MySQL" else 5432)
-            
-            if db_type == "SQLite":
-                db_path = st.text_input("Database File Path *")
-            else:
-                db_name = st.text_input("Database Name *")
+            # Fields are batched in a form so typing credentials doesn't rerun the script;
+            # the database type stays outside because it decides which fields are shown
+            with st.form("db_conn", clear_on_submit=False):
+                if db_type != "SQLite":
+                    db_host = st.text_input("Host *", value="localhost")
+                    db_user = st.text_input("Username *", value="root")
+                    db_password = st.text_input("Password *", type="password")
+                    db_port = st.number_input("Port *", min_value=1, max_value=65535, 
+                                            value=3306 if db_type == "MySQL" else 5432)
+                
+                if db_type == "SQLite":
+                    db_path = st.text_input("Database File Path *")
+                else:
+                    db_name = st.text_input("Database Name *")
+                
+                # Add a submit button for database settings
+                submitted = st.form_submit_button("Connect to Database", type="primary")
             
-            # Add a submit button for database settings
-            if st.button("Connect to Database", type="primary"):
+            if submitted:
                 # Validate required fields
                 if db_type == "SQLite":
                     if not db_path:
@@ -202,6 +350,7 @@ def main():
                                 "type": db_type,
                                 "path": db_path
                             }
+                            st.session_state.db_engine = get_db_engine(st.session_state.db_config)
                             st.session_state.db_connected = True
                             st.success(message)
                         else:
@@ -221,6 +370,7 @@ def main():
                                 "database": db_name,
                                 "port": db_port
                             }
+                            st.session_state.db_engine = get_db_engine(st.session_state.db_config)
                             st.session_state.db_connected = True
                             st.success(message)
                         else:
@@ -234,23 +384,6 @@ def main():
         st.warning("⚠️ Please configure and connect to your database first")
         return
     
-    prompt = [
-        """You are a healthcare SQL expert. Database schema:
-        PATIENTS (patient_id, first_name, last_name, dob, gender, phone, insurance_id)
-        DOCTORS (doctor_id, first_name, last_name, specialization, department_id, license_number, phone)
-        DEPARTMENTS (department_id, name, head_doctor_id)
-        APPOINTMENTS (appointment_id, patient_id, doctor_id, appointment_date, status)
-        MEDICAL_RECORDS (record_id, patient_id, doctor_id, diagnosis, prescription, record_date)
-        LAB_RESULTS (lab_id, patient_id, test_name, test_date, result_value, reference_range)
-        
-        Rules:
-        1. Use explicit JOIN syntax
-        2. Format dates using DATE_FORMAT()
-        3. Always qualify column names with table aliases
-        4. Include relevant WHERE clauses
-        5. Handle NULL values appropriately"""
-    ]
-    
     try:
         question = st.text_area("Enter your healthcare data question:", 
                               placeholder="e.g., Show patients with cholesterol levels above 200 mg/dL",
@@ -260,49 +393,58 @@ def main():
             if not question:
                 st.warning("⚠️ Please enter a question")
                 return
-                
+            
+            st.session_state.query_result = None
             with st.spinner("🔍 Analyzing data..."):
                 try:
                     # Generate and execute query
-                    sql = get_gemini_response(question, prompt)
+                    sql = get_gemini_response(question, PROMPT)
                     
-                    # Prepare database parameters based on type
-                    if st.session_state.db_config["type"] == "SQLite":
-                        columns, data = execute_sql_query(sql, 
-                                                        st.session_state.db_config["type"],
-                                                        None, None, None, 
-                                                        st.session_state.db_config["path"])
-                    else:
-                        columns, data = execute_sql_query(sql, 
-                                                        st.session_state.db_config["type"],
-                                                        st.session_state.db_config["host"],
-                                                        st.session_state.db_config["user"],
-                                                        st.session_state.db_config["password"],
-                                                        st.session_state.db_config["database"],
-                                                        st.session_state.db_config["port"])
+                    statements, skipped_statements = prepare_sql_statements(sql, st.session_state.db_engine.dialect.name)
+                    df = execute_sql_query(statements, st.session_state.db_engine)
                     
-                    # Display results
-                    st.subheader("Generated SQL Query")
-                    st.code(sql, language="sql")
+                    truncated = df is not None and len(df) > MAX_RESULT_ROWS
+                    if truncated:
+                        df = df.head(MAX_RESULT_ROWS)
                     
-                    if columns and data:
-                        st.subheader("Analysis Results")
-                        df = pd.DataFrame(data, columns=columns)
-                        st.dataframe(df, use_container_width=True)
-                        
-                        # Basic visualizations
-                        if len(df) > 0:
-                            numeric_cols = df.select_dtypes(include=['number']).columns
-                            if not numeric_cols.empty:
-                                selected_col = st.selectbox("Select column to visualize:", numeric_cols)
-                                st.line_chart(df[selected_col])
-                    else:
-                        st.info("ℹ️ No results found for this query")
-                        
+                    # Kept in session state so widget reruns (e.g. the chart column selectbox)
+                    # redraw the results without querying again
+                    st.session_state.query_result = {
+                        "sql": "\n".join(statements) or sql,
+                        "skipped_statements": skipped_statements,
+                        "df": df,
+                        "truncated": truncated
+                    }
                 except Exception as e:
                     st.error(f"❌ Error processing request: {str(e)}")
                     st.error("Stack trace:")
                     st.code(traceback.format_exc())
+        
+        # Display results, showing the SQL as actually executed (row limit included)
+        query_result = st.session_state.query_result
+        if query_result is not None:
+            st.subheader("Generated SQL Query")
+            st.code(query_result["sql"], language="sql")
+            if query_result["skipped_statements"]:
+                st.info(f"ℹ️ Skipped {len(query_result['skipped_statements'])} earlier SELECT statement(s); "
+                        "only the last statement's results are shown")
+                st.code("\n".join(query_result["skipped_statements"]), language="sql")
+            
+            df = query_result["df"]
+            if df is not None and not df.empty:
+                st.subheader("Analysis Results")
+                if query_result["truncated"]:
+                    st.info(f"ℹ️ Results truncated to {MAX_RESULT_ROWS} rows")
+                st.dataframe(df, use_container_width=True)
+                
+                # Basic visualizations
+                numeric_cols = get_numeric_columns(df.dtypes.tolist())
+                if numeric_cols:
+                    selected_col = st.selectbox("Select column to visualize:", numeric_cols,
+                                                format_func=lambda position: str(df.columns[position]))
+                    st.altair_chart(build_line_chart(df, selected_col), use_container_width=True)
+            else:
+                st.info("ℹ️ No results found for this query")
     except Exception as e:
         st.error(f"❌ Error in main UI: {str(e)}")
         st.error("Stack trace:")